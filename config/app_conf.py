@@ -13,8 +13,11 @@ Copyright (C) 2023
    - app_conf.py <options>
 
 """
+from types import MappingProxyType
+from typing import Mapping, Tuple
 
-positions = {
+# Read-only: shared by every badge, never copied or modified at runtime
+positions: Mapping[str, str] = MappingProxyType({
    "A": "Assistant",
    "SA": "Senior Assistant",
    "SME": "Subject Matter Expert",
@@ -27,6 +30,6 @@ positions = {
    "SD": "Senior Director",
    "VP": "Vice President",
    "CEO": "CEO"
-   }
+   })
 
-file_extensions = ['png', 'jpg', 'bmp', 'jpeg']
+file_extensions: Tuple[str, ...] = ('png', 'jpg', 'bmp', 'jpeg')
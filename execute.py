@@ -8,7 +8,9 @@
 """
 
 import argparse
-import glob
+import collections
+import functools
+import io
 import logging.config
 import os
 import pathlib
@@ -17,11 +19,12 @@ import sys
 import time
 import unicodedata
 from argparse import ArgumentDefaultsHelpFormatter as Formatter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import cv2
 import numpy as np
-import qrcode
-from PIL import Image, ImageDraw, ImageFont
+import segno
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
 from tools.util import Utilities as uT
 
@@ -29,6 +32,27 @@ logger = logging.getLogger()
 CUR_PATH = pathlib.Path().resolve()
 CONF = './config/'
 config = None
+_WORKER = {}
+_POSITIONS = uT.get_dict_positions()
+_POSITION_NAMES = frozenset(pos.upper() for pos in _POSITIONS.values())
+# Supported image suffixes, for a single C-level str.endswith() check
+_EXTS = tuple('.' + ext for ext in uT.get_list_file_extensions())
+# Config values used by every badge, read once per run instead of per badge
+Settings = collections.namedtuple("Settings", [
+   "tmp_path", "img_prefix", "tpl_avatar_x", "tpl_avatar_y", "tpl_avatar_w",
+   "tpl_avatar_h", "tpl_w", "tpl_h", "tpl_padding", "scale_factor",
+   "bg_color", "text_styles", "qr_version", "qr_box_size", "qr_border",
+   "qr_fit", "qr_fill_color", "qr_back_color", "qr_x", "qr_y",
+   "base_text_size"])
+# Face detection runs on a copy whose longer side is scaled down to this
+FACE_DETECT_SIZE = 480
+# Face detection models ship next to this script, whatever the working dir
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "Haar Cascade")
+FACE_CASCADE_PATH = os.path.join(MODEL_PATH,
+                                 "haarcascade_frontalface_default.xml")
+# Optional YuNet model, Haar cascade is used when it is not there
+FACE_MODEL_PATH = os.path.join(MODEL_PATH, "face_detection_yunet_2023mar.onnx")
 
 
 class ImageSizeException(Exception):
@@ -57,28 +81,90 @@ class Utility(object):
       return conf
 
    @staticmethod
-   def validate(string, regex):
+   def get_settings(conf):
+      """
+      Read the per-badge options out of the config
+      :param conf: ConfigParser
+      :return: Settings
+      """
+      return Settings(
+         tmp_path=os.path.join(CUR_PATH, conf.get("general", "tmppath")),
+         img_prefix=conf.get("general", "imgprefix"),
+         tpl_avatar_x=conf.getint("template", "avatax"),
+         tpl_avatar_y=conf.getint("template", "avatay"),
+         tpl_avatar_w=conf.getint("template", "avataw"),
+         tpl_avatar_h=conf.getint("template", "avatah"),
+         tpl_w=conf.getint("template", "width"),
+         tpl_h=conf.getint("template", "height"),
+         tpl_padding=conf.getint("template", "padding"),
+         scale_factor=conf.getfloat("avata", "scalefactor"),
+         bg_color=conf.get("general", "backgroundcolor"),
+         # (font path, size, top padding, color) of each text block
+         text_styles={
+            sec: (os.path.join(CUR_PATH, conf.get(sec, "font")),
+                  conf.getint(sec, "size"),
+                  conf.getint(sec, "toppad"),
+                  conf.get(sec, "color"))
+            for sec in ("username", "position", "userid")},
+         qr_version=conf.getint("qrcode", "version"),
+         qr_box_size=conf.getint("qrcode", "boxsize"),
+         qr_border=conf.getint("qrcode", "border"),
+         qr_fit=conf.getboolean("qrcode", "fit"),
+         qr_fill_color=conf.get("qrcode", "fillcolor"),
+         qr_back_color=conf.get("qrcode", "backcolor"),
+         qr_x=conf.getint("qrcode", "qrx"),
+         qr_y=conf.getint("qrcode", "qry"),
+         base_text_size=conf.getint("general", "basetextsize"))
+
+   @staticmethod
+   def validate(string, pattern):
       """
       Use for validating a string
       :param string: input string
-      :param regex: regular expression to verify the string
+      :param pattern: compiled regular expression to verify the string
       :return:
       """
       result = ""
-      if re.search(regex, string):
+      if pattern.search(string):
          result = string
       else:
-         logger.error("[{}] is not match [{}]".format(string, regex))
+         logger.error("[{}] is not match [{}]".format(string, pattern.pattern))
       return result
 
    @staticmethod
-   def convert_img(input_img):
+   def qr_to_image(qr, scale, border, dark="black", light="white"):
+      """
+      Render a segno QR code as a PIL image
+      :param qr: segno.QRCode
+      :param scale: size of a module in pixels
+      :param border: quiet zone in modules
+      :param dark: color of the dark modules
+      :param light: color of the light modules
+      :return: PIL image, usable as its own paste mask
+      """
+      buf = io.BytesIO()
+      # Decoded right away, compression would only cost time
+      qr.save(buf, kind="png", scale=scale, border=border, dark=dark,
+              light=light, compresslevel=1)
+      buf.seek(0)
+      qr_img = Image.open(buf)
+      if qr_img.mode != "1":
+         qr_img = qr_img.convert("RGBA")
+      return qr_img
+
+   @staticmethod
+   def load_template(template, alpha=None):
       """
-      Convert image
-      :param input_img: input image
-      :return: converted image
+      Decode the badge template once so it can be shared between badges
+      :param template: template file path
+      :param alpha: optional constant opacity applied to the whole template
+      :return: RGBA template image
       """
-      return cv2.imdecode(np.fromfile(input_img, dtype=np.uint8), -1)
+      template_img = Image.open(template, 'r').convert("RGBA")
+      if alpha is not None:
+         template_img.putalpha(alpha)
+      template_img.load()
+      return template_img
 
    @staticmethod
    def countdown(due_time):
@@ -94,6 +180,17 @@ class Utility(object):
          time.sleep(1)
          due_time -= 1
 
+   @staticmethod
+   def list_images(folder):
+      """
+      List the supported images of a folder with a single directory scan
+      :param folder: folder to scan (not recursive)
+      :return: image file names
+      """
+      with os.scandir(folder) as entries:
+         return [entry.name for entry in entries
+                 if entry.is_file() and entry.name.lower().endswith(_EXTS)]
+
    @staticmethod
    def check_folder(folders):
       """
@@ -101,14 +198,15 @@ class Utility(object):
       :param folders: Target folder(s)
       """
       for folder in folders:
-         if not os.path.isdir(folder):
-            logger.debug("Making dir: %s" % folder)
-            os.mkdir(folder)
-         else:
-            files = glob.glob(folder)
-            for f in files:
-               logger.debug("Removing: %s" % f)
-               os.remove(f)
+         logger.debug("Checking dir: %s" % folder)
+         os.makedirs(folder, exist_ok=True)
+         with os.scandir(folder) as entries:
+            for entry in entries:
+               # Only generated images, the tracked README placeholders stay
+               if entry.is_file() and \
+                     entry.name.lower().endswith(_EXTS + ('.webp',)):
+                  logger.debug("Removing: %s" % entry.path)
+                  os.unlink(entry.path)
 
    @staticmethod
    def resize_with_aspect_ratio(image, width=None, height=None,
@@ -134,83 +232,166 @@ class Utility(object):
       return cv2.resize(image, dim, interpolation=inter)
 
 
+@functools.lru_cache(maxsize=64)
+def _load_font(path, size):
+   """
+   Load a TrueType font once per (path, size)
+   :param path: font file path
+   :param size: font size
+   :return: ImageFont.FreeTypeFont
+   """
+   return ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _text_bbox(path, size, msg):
+   """
+   Measure a text once per (font, size, text), position titles repeat a lot
+   :param path: font file path
+   :param size: font size
+   :param msg: text to measure
+   :return: bounding box (left, top, right, bottom)
+   """
+   return _load_font(path, size).getbbox(msg)
+
+
+@functools.lru_cache(maxsize=8)
+def _static_qr(text):
+   """
+   Render the --qr-text code once, it is the same on every badge
+   :param text: QR code content
+   :return: PIL image of the QR code
+   """
+   # Same as qrcode.make(): its default M level, unlike the per-user code
+   qr = segno.make_qr(text, error="m", boost_error=False)
+   return Utility.qr_to_image(qr, 10, 4)
+
+
 class ImageMaker(object):
    """docstring for ImageMaker"""
+   _FACE_CASCADE = None
+   _FACE_MODEL = None
+   _RE_NAME = re.compile(r"^[\w.\- ]+$")
+   _RE_ID = re.compile(r"^\w?\d+$")
 
-   def __init__(self, name, arg, conf):
+   def __init__(self, name, arg, settings, template_img=None):
       super(ImageMaker, self).__init__()
       self.arg = arg
       self.name = name
+      self.template_img = template_img
+      # tmp_path, template geometry, text styles, QR options, ...
+      self.settings = settings
       self.src_path = os.path.join(CUR_PATH, arg.src_path)
       self.des_path = os.path.join(CUR_PATH, arg.des_path)
-      self.tmp_path = os.path.join(CUR_PATH, conf.get("general", "tmppath"))
+      self.src_file = os.path.join(self.src_path, name)
+      # Intermediate images, only written in debug/test mode
+      self.tmp_resized = os.path.join(settings.tmp_path, name)
+      self.tmp_cropped = os.path.join(settings.tmp_path, "cr_" + name)
+      self.tmp_faces = os.path.join(settings.tmp_path, "faces_" + name)
       self.template = os.path.join(CUR_PATH, arg.template)
       self.debug = arg.debug or False
-      self.img_prefix = conf.get("general", "imgprefix")
-      self.tpl_avatar_x = conf.getint("template", "avatax")
-      self.tpl_avatar_y = conf.getint("template", "avatay")
-      self.tpl_avatar_w = conf.getint("template", "avataw")
-      self.tpl_avatar_h = conf.getint("template", "avatah")
-      self.tpl_w = conf.getint("template", "width")
-      self.tpl_h = conf.getint("template", "height")
-      self.conf = conf
-      self.base_text_size = self.conf.getint("general", "basetextsize")
-      self.positions = uT.get_dict_positions()
-      self.re_name = "^[\w\.\- ]+$"
-      self.re_id = "^[\w]?[\d]+$"
-
-      self.img = self.img_resized = self.img_cropped = self.bg_img = None
+      self.positions = _POSITIONS
+
+      self.img = self.img_cropped = self.bg_img = None
       self.user_pos = self.positions["E"]
       self.user_name = self.user_id = ""
       self.img_num = 1
 
-   def get_focus_position(self, input_img):
+   @classmethod
+   def _get_cascade(cls):
+      """
+      Load the face cascade once and share it between all instances
+      :return: cv2.CascadeClassifier
+      """
+      if cls._FACE_CASCADE is None:
+         cascade = cv2.CascadeClassifier(FACE_CASCADE_PATH)
+         if cascade.empty():
+            # An empty classifier silently finds no faces
+            raise IOError("Unable to load the face cascade: %s" %
+                          FACE_CASCADE_PATH)
+         cls._FACE_CASCADE = cascade
+      return cls._FACE_CASCADE
+
+   @classmethod
+   def _get_face_model(cls):
+      """
+      Load the YuNet face detector once, if its model file is installed
+      :return: cv2.FaceDetectorYN or None
+      """
+      if cls._FACE_MODEL is None:
+         cls._FACE_MODEL = False
+         if (os.path.isfile(FACE_MODEL_PATH) and
+               hasattr(cv2, "FaceDetectorYN")):
+            cls._FACE_MODEL = cv2.FaceDetectorYN.create(FACE_MODEL_PATH, "",
+                                                        (320, 320))
+      return cls._FACE_MODEL or None
+
+   def detect_faces(self, image, scale):
+      """
+      Detect faces with YuNet when available, the Haar cascade otherwise
+      :param image: RGB(A) image as a numpy array
+      :param scale: size of image relative to the crop layout frame
+      :return: face rects (x, y, w, h) in image coordinates
+      """
+      rgba = image.shape[2] == 4
+      detector = self._get_face_model()
+      if detector is not None:
+         detector.setInputSize((image.shape[1], image.shape[0]))
+         _, faces = detector.detect(cv2.cvtColor(
+               image, cv2.COLOR_RGBA2BGR if rgba else cv2.COLOR_RGB2BGR))
+         return () if faces is None else faces[:, :4].astype(int)
+      return self._get_cascade().detectMultiScale(
+            cv2.cvtColor(image, cv2.COLOR_RGBA2GRAY if rgba
+                         else cv2.COLOR_RGB2GRAY),
+            # scaleFactor=1.2,
+            scaleFactor=self.settings.scale_factor,
+            minNeighbors=3,
+            minSize=(int(30 * scale),) * 2,
+            maxSize=(int(200 * scale),) * 2,
+            flags=cv2.CASCADE_SCALE_IMAGE)
+
+   def get_focus_position(self, src_image):
       """
       Used to detect faces in the image then return the focus position
-      :param input_img: The input image
+      :param src_image: The RGB(A) image as a numpy array
       :return: Focus position of the image (x, y)
       """
-      face_cascade = cv2.CascadeClassifier(
-            "Haar Cascade/haarcascade_frontalface_default.xml")
-      image = Utility.convert_img(input_img)
-      gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-      faces = face_cascade.detectMultiScale(gray_image,
-                                            # scaleFactor=1.2,
-                                            scaleFactor=self.conf.getfloat(
-                                                  "avata", "scalefactor"),
-                                            minNeighbors=3,
-                                            minSize=(30, 30),
-                                            maxSize=(200, 200),
-                                            flags=cv2.CASCADE_SCALE_IMAGE)
+      image = None
+      if self.debug:
+         image = cv2.cvtColor(src_image, cv2.COLOR_RGBA2BGR
+                              if src_image.shape[2] == 4
+                              else cv2.COLOR_RGB2BGR)
+      # Detection cost grows with the pixel count, search a smaller copy
+      scale = 1.0
+      if max(src_image.shape[:2]) > FACE_DETECT_SIZE:
+         scale = FACE_DETECT_SIZE / float(max(src_image.shape[:2]))
+         src_image = cv2.resize(src_image, None, fx=scale, fy=scale,
+                                interpolation=cv2.INTER_AREA)
+      faces = self.detect_faces(src_image, scale)
 
       logger.info("Found {0} faces!".format(len(faces)))
       x = y = 0
-      # when face(s) detected
+      # when face(s) detected, focus on the mean of the face centers
       if len(faces):
-         # Track the base position (of the very first face)
-         a, b, c, d = faces[0]
+         # back to the coordinates of the input image
+         faces = (np.asarray(faces) / scale).astype(int)
+         x = int((faces[:, 0] + faces[:, 2] / 2).mean())
+         y = int((faces[:, 1] + faces[:, 3] / 2).mean())
+      if self.debug:
          for (i, j, w, h) in faces:
             logger.debug("Detected face : [{},{},{},{}]".format(i, j, w, h))
-            c = int((c + w) / 2)
-            d = int((d + h) / 2)
-            a = int((a + i) / 2)
-            b = int((b + j) / 2)
-            x = a + int(c / 2)
-            y = b + int(d / 2)
-            if self.arg.debug:
-               cv2.rectangle(image,
-                             (i + int(w / 2), j + int(h / 2)),
-                             (i + int(w / 2) + 2, j + int(h / 2) + 2),
-                             (0, 200, 100), 2)
-               cv2.rectangle(image, (i, j), (i + w, j + h), (0, 200, 100), 2)
-               cv2.rectangle(image, (x, y), (x + 2, y + 2), (0, 255, 255), 2)
-      if self.debug:
-         resize = Utility.resize_with_aspect_ratio(image, height=1024)
-         cv2.imshow("Faces found", resize)
-         cv2.imwrite(self.tmp_path + "faces_" + str(self.name),
-                     image)
-         if self.arg.test and self.arg.verbose:
-            cv2.waitKey(0)
+            cv2.rectangle(image,
+                          (i + int(w / 2), j + int(h / 2)),
+                          (i + int(w / 2) + 2, j + int(h / 2) + 2),
+                          (0, 200, 100), 2)
+            cv2.rectangle(image, (i, j), (i + w, j + h), (0, 200, 100), 2)
+         cv2.rectangle(image, (x, y), (x + 2, y + 2), (0, 255, 255), 2)
+         cv2.imwrite(self.tmp_faces, image)
+         if not _WORKER.get("parallel"):
+            resize = Utility.resize_with_aspect_ratio(image, height=1024)
+            cv2.imshow("Faces found", resize)
+            if self.arg.test and self.arg.verbose:
+               cv2.waitKey(0)
       logger.debug("Focus coordinate : [{},{}]".format(x, y))
       return x, y
 
@@ -221,73 +402,70 @@ class ImageMaker(object):
       :param src_path: Source path
       :param des_path: Desination path
       """
-      files = []
-      format_list = uT.get_list_file_extensions()
-      logger.debug(os.listdir(src_path))
-      f = [fi for fi in os.listdir(src_path) if os.path.isfile(src_path + fi)]
-      logger.debug("File List : %s" % [item for item in f])
-      for file in f:
-         if any(s for s in format_list if s in file):
-            files.append(u'{}'.format(file))
-
-      for f in files:
-         # name = f.split(".")[0].replace(" ", "-")
-         name = f.split(".")[0]
-         file_name = os.path.join(src_path, f)
-         logger.info("Converting : %s to PNG format ..." % file_name)
-         im = Image.open(file_name).convert("RGBA")
-         im.save(des_path + name + '.png', format="png")
+      files = Utility.list_images(src_path)
+      logger.debug("File List : %s" % [item for item in files])
+
+      # name = f.split(".")[0].replace(" ", "-")
+      jobs = [(os.path.join(src_path, f), des_path + f.split(".")[0] + '.png')
+              for f in files]
+      # Pillow releases the GIL while decoding/encoding, threads are enough
+      with ThreadPoolExecutor(max_workers=min(32, os.cpu_count() * 2)) as ex:
+         list(ex.map(ImageMaker._convert_one, jobs))
+
+   @staticmethod
+   def _convert_one(job):
+      """
+      Convert a single image to PNG
+      :param job: (source file, destination file)
+      """
+      file_name, out_file = job
+      logger.info("Converting : %s to PNG format ..." % file_name)
+      im = Image.open(file_name).convert("RGBA")
+      im.save(out_file, format="png", compress_level=1)
 
    def correct_img(self):
       """
       Correct the image
       """
-      orientation = 274  # get 274 through upper loop
+      # Handles all eight orientations, mirrored ones included, and drops
+      # the tag so the badge is not rotated twice by a viewer
       try:
-         exif = self.img._getexif()
-         if exif:
-            exif = dict(exif.items())
-            if exif[orientation] == 3:
-               self.img.rotate(180, expand=True)
-            elif exif[orientation] == 6:
-               self.img.rotate(270, expand=True)
-            elif exif[orientation] == 8:
-               self.img.rotate(90, expand=True)
+         # On Pillow 9 exif_transpose() copies, and so decodes, even upright
+         # images, which would defeat the draft() in crop_then_resize()
+         if self.img.getexif().get(0x0112, 1) != 1:
+            self.img = ImageOps.exif_transpose(self.img)
       except Exception as err:
+         # A broken EXIF block should not cost the badge
          logger.error(err)
-         # There is AttributeError: _getexif sometimes.
-         pass
 
-   def resize_img(self):
+   def crop_then_resize(self):
       """
-      Resize image
+      Crop the avatar around the detected faces, then resize only the crop
       :return:
       """
       img_w, img_h = self.img.size
       logger.info("Width: %f, Height: %f" % (img_w, img_h))
-      basewidth = self.tpl_avatar_w + self.conf.getint("template", "padding")
+      basewidth = self.settings.tpl_avatar_w + self.settings.tpl_padding
+      if basewidth < min(img_w, img_h):
+         # Let the JPEG decoder work at a reduced scale before resampling
+         self.img.draft("RGB", (int(img_w * basewidth / min(img_w, img_h)),
+                                int(img_h * basewidth / min(img_w, img_h))))
+         inter = cv2.INTER_AREA
+      else:
+         inter = cv2.INTER_LANCZOS4
+      if self.img.mode not in ("RGB", "RGBA"):
+         self.img = self.img.convert("RGBA")
+      arr = np.asarray(self.img)
+      img_h, img_w = arr.shape[:2]
+      # The crop is laid out on the image scaled to a basewidth short side
+      ratio = basewidth / float(min(img_w, img_h))
       if img_h >= img_w:
-         wpercent = (basewidth / float(img_w))
-         hsize = int((float(img_h) * float(wpercent)))
-         self.img_resized = self.img.resize((basewidth, hsize),
-                                            Image.LANCZOS)
+         size = (basewidth, int(img_h * ratio))
       else:
-         hpercent = (basewidth / float(img_h))
-         wsize = int((float(img_w) * float(hpercent)))
-         self.img_resized = self.img.resize((wsize, basewidth),
-                                            Image.ANTIALIAS)
-      # cropped_example = cropped_example.resize((basewidth,hsize),
-      # Image.ANTIALIAS)
-      logger.debug("Resized image: %f x %f" % self.img_resized.size)
-      self.img_resized.save(self.tmp_path + self.name, format="png")
-
-   def crop_img(self):
-      """
-      Crop image
-      """
-      basewidth = self.tpl_avatar_w + self.conf.getint("template", "padding")
-      x, y = self.get_focus_position(self.tmp_path + self.name)
-      img_r_w, img_r_h = self.img_resized.size
+         size = (int(img_w * ratio), basewidth)
+      x, y = self.get_focus_position(
+            cv2.resize(arr, size, interpolation=inter))
+      img_r_w, img_r_h = size
       if img_r_w < basewidth or img_r_h < basewidth:
          raise ImageSizeException("Image is too small, Please try another.")
       base_w = basewidth / 2
@@ -302,20 +480,29 @@ class ImageMaker(object):
          if y - base_w <= 0:
             y = base_w
          elif y + base_w > img_r_h:
-            y = base_w
+            y = img_r_h - base_w
       correct_x, correct_y = x - base_w, y - base_w
       correct_w, correct_h = basewidth + correct_x, basewidth + correct_y
       logger.debug("[x:{}, y:{}] - [c_x:{}, c_y:{}] - [w:{}, h:{}]".format(
             x, y, correct_x, correct_y, basewidth, basewidth))
-      draw = ImageDraw.Draw(self.img_resized)
       if self.debug:
+         img_resized = Image.fromarray(
+               cv2.resize(arr, size, interpolation=inter))
+         draw = ImageDraw.Draw(img_resized)
          draw.rectangle([correct_x, correct_y, correct_w, correct_h], width=3,
                         outline="#0000ff")
-      self.img_cropped = self.img_resized.crop((correct_x, correct_y,
-                                                correct_w, correct_h))
+         img_resized.save(self.tmp_resized, format="png", compress_level=1)
+      # Back to the coordinates of the source image
+      x0, y0 = int(round(correct_x / ratio)), int(round(correct_y / ratio))
+      x1 = min(int(round(correct_w / ratio)), img_w)
+      y1 = min(int(round(correct_h / ratio)), img_h)
+      arr = cv2.resize(arr[max(y0, 0):y1, max(x0, 0):x1],
+                       (basewidth, basewidth), interpolation=inter)
+      self.img_cropped = Image.fromarray(arr)
       logger.debug("Cropped image: %f x %f" % self.img_cropped.size)
-      if self.arg.debug or self.arg.test:
-         self.img_cropped.save(self.tmp_path + "cr_" + self.name, format="png")
+      if self.debug or self.arg.test:
+         self.img_cropped.save(self.tmp_cropped, format="png",
+                               compress_level=1)
 
    def parse_user_info(self):
       """
@@ -323,25 +510,27 @@ class ImageMaker(object):
       Parse user information
       :return: 
       """
-      img_info_arr = self.name.split(".")[0].split("_")
+      # macOS hands out decomposed (NFD) names, whose combining marks would
+      # fail the name pattern; the file itself is still opened by self.name
+      name = unicodedata.normalize("NFC", self.name)
+      img_info_arr = name.split(".")[0].split("_")
       self.user_name = Utility.validate(img_info_arr[0].strip(),
-                                        self.re_name)
-      if self.user_name == 0:
+                                        self._RE_NAME)
+      if not self.user_name:
          raise UserInfoException("User name not found!")
       self.user_pos = img_info_arr[2].capitalize()
       if self.user_pos.strip().upper() in self.positions:
          self.user_pos = self.positions[self.user_pos.strip().upper()]
          logger.info("pos: {}".format(self.user_pos))
-      elif self.user_pos.strip().upper() in list(map(str.upper, 
-                                                     self.positions.values())):
+      elif self.user_pos.strip().upper() in _POSITION_NAMES:
          self.user_pos = self.user_pos.strip().upper()
          logger.info("pos: {}".format(self.user_pos))
       else:
          logger.error(
                "[{}] is not in [{}]".format(self.user_pos, self.positions))
          raise UserInfoException("User position is incorrect!")
-      self.user_id = Utility.validate(img_info_arr[1].strip(), self.re_id)
-      if self.user_id == 0:
+      self.user_id = Utility.validate(img_info_arr[1].strip(), self._RE_ID)
+      if not self.user_id:
          raise UserInfoException("User ID not found!")
       if len(img_info_arr) == 4:
          self.img_num = img_info_arr[3]
@@ -350,28 +539,25 @@ class ImageMaker(object):
       """
       Make QR code
       """
-      # Make RQ code
-      qr = qrcode.QRCode(version=self.conf.getint("qrcode", "version"),
-                         error_correction=qrcode.constants.ERROR_CORRECT_L,
-                         box_size=self.conf.getint("qrcode", "boxsize"),
-                         border=self.conf.getint("qrcode", "border"))
       name = unicodedata.normalize('NFKD', self.user_name).encode('ascii',
                                                                   'ignore')
       img_info = "Fullname: %s,Position: %s, Badge_Id: %s, Company: %s" % (
          name, self.user_pos, self.user_id, "https://www.tma.vn")
       logger.info("info: {}".format(img_info))
+      # Make RQ code
+      settings = self.settings
       if self.arg.qr_text:
-         qr_img = qrcode.make(self.arg.qr_text)
+         qr_img = _static_qr(self.arg.qr_text)
       else:
-         qr.add_data(img_info)
-         qr.make(fit=self.conf.get("qrcode", "fit"))
-         qr_img = qr.make_image(fill_color=self.conf.get("qrcode",
-                                                         "fillcolor"),
-                                back_color=self.conf.get("qrcode",
-                                                         "backcolor"))
-      qrx = self.conf.getint("qrcode", "qrx")
-      qry = self.conf.getint("qrcode", "qry")
-      self.bg_img.paste(qr_img, (qrx, qry), mask=qr_img)
+         # "fit" lets segno pick the smallest version holding the data
+         version = None if settings.qr_fit else settings.qr_version
+         qr = segno.make_qr(img_info, error="l", boost_error=False,
+                            version=version)
+         qr_img = Utility.qr_to_image(qr, settings.qr_box_size,
+                                      settings.qr_border,
+                                      settings.qr_fill_color,
+                                      settings.qr_back_color)
+      self.bg_img.paste(qr_img, (settings.qr_x, settings.qr_y), mask=qr_img)
 
    def execute(self):
       """
@@ -380,96 +566,114 @@ class ImageMaker(object):
       """
       try:
          logger.info("Processing Image: %s" % self.name)
-         template_img = Image.open(self.template, 'r')
+         template_img = self.template_img
+         if template_img is None:
+            template_img = Utility.load_template(
+                  self.template, 125 if self.arg.test else None)
          tpl_w, tpl_h = template_img.size
 
-         self.img = Image.open(self.src_path + self.name, 'r').convert(
-               "RGBA")
+         self.img = Image.open(self.src_file, 'r')
          curr_y = 0.0
          self.correct_img()
-         self.resize_img()
-         self.crop_img()
-         # Make background
-         self.bg_img = Image.new('RGBA', (tpl_w, tpl_h), self.conf.get(
-               "general", "backgroundcolor"))
+         self.crop_then_resize()
+         # Make background, badges are opaque so three channels are enough
+         settings = self.settings
+         self.bg_img = Image.new('RGB', (tpl_w, tpl_h), settings.bg_color)
          img_cropped_w, img_cropped_h = self.img_cropped.size
-         img_cropped_pos = (int(self.tpl_avatar_x - (img_cropped_w / 2)),
-                            int(self.tpl_avatar_y - (img_cropped_h / 2)))
+         img_cropped_pos = (int(settings.tpl_avatar_x - (img_cropped_w / 2)),
+                            int(settings.tpl_avatar_y - (img_cropped_h / 2)))
          self.parse_user_info()
-         if self.arg.verbose:
-            self.img_cropped.save(self.tmp_path + self.user_id + ".png",
-                                  format="png")
-         self.bg_img.paste(self.img_cropped, img_cropped_pos)
-         if self.arg.test:
-            template_img.putalpha(125)
+         if self.arg.verbose and (self.debug or self.arg.test):
+            self.img_cropped.save(
+                  os.path.join(settings.tmp_path, self.user_id + ".png"),
+                  format="png", compress_level=1)
+         self.bg_img.paste(self.img_cropped, img_cropped_pos,
+                           mask=self.img_cropped
+                           if self.img_cropped.mode == "RGBA" else None)
          self.bg_img.paste(template_img, (0, 0), mask=template_img)
          if self.arg.no_generate_qr:
             self.parse_qr_code()
          draw = ImageDraw.Draw(self.bg_img)
 
-         curr_y += self.tpl_avatar_y + img_cropped_pos[1]
-         th = self.conf.getint("username", "toppad")
+         curr_y += settings.tpl_avatar_y + img_cropped_pos[1]
+         font_path, size, th, color = settings.text_styles["username"]
          if self.user_name:
             curr_y += th
-            if self.arg.no_auto_size:
-               size = self.conf.getint("username", "size")
-            else:
-               size = self.base_text_size
-            n_size = size
-            while True:
-               font = ImageFont.truetype(os.path.join(CUR_PATH,
-                                                      self.conf.get(
-                                                            "username",
-                                                            "font")), n_size)
-               msg = self.user_name.upper().strip()
-               tw, th = draw.textsize(msg, font=font)
-               logger.info("info: {} {} {}".format(msg, tw, th))
-               if tw < (tpl_w - 50):
-                  break
-               else:
-                  n_size = n_size - 5
-            draw.text(((tpl_w - tw) / 2, curr_y), msg, self.conf.get(
-                  "username", "color"), font=font)
+            if not self.arg.no_auto_size:
+               size = settings.base_text_size
+            msg = self.user_name.upper().strip()
+            max_w = tpl_w - 50
+            text_w = _text_bbox(font_path, size, msg)[2]
+            if text_w >= max_w:
+               # Text width grows linearly with the font size
+               size = max(8, int(size * max_w / text_w))
+               if _text_bbox(font_path, size, msg)[2] >= max_w:
+                  # Hinting/rounding can leave it a hair too wide, bisect
+                  # down to the largest size that fits
+                  lo, hi = 8, size - 1
+                  while lo < hi:
+                     mid = (lo + hi + 1) // 2
+                     if _text_bbox(font_path, mid, msg)[2] < max_w:
+                        lo = mid
+                     else:
+                        hi = mid - 1
+                  size = lo
+            font = _load_font(font_path, size)
+            _, _, tw, th = _text_bbox(font_path, size, msg)
+            logger.info("info: {} {} {}".format(msg, tw, th))
+            draw.text(((tpl_w - tw) / 2, curr_y), msg, color, font=font)
 
          if self.user_pos:
-            curr_y += th + self.conf.getint("position", "toppad")
-            if self.arg.no_auto_size:
-               size = self.conf.getint("position", "size")
-            else:
-               size = self.base_text_size - 10
-            font = ImageFont.truetype(os.path.join(CUR_PATH, self.conf.get(
-                  "position",
-                  "font")), size)
+            font_path, size, toppad, color = settings.text_styles["position"]
+            curr_y += th + toppad
+            if not self.arg.no_auto_size:
+               size = settings.base_text_size - 10
+            font = _load_font(font_path, size)
             msg = self.user_pos.strip()
-            tw, th = draw.textsize(msg, font=font)
-            draw.text(((tpl_w - tw) / 2, curr_y), msg, self.conf.get(
-                  "position", "color"), font=font)
+            _, _, tw, th = _text_bbox(font_path, size, msg)
+            draw.text(((tpl_w - tw) / 2, curr_y), msg, color, font=font)
 
          if self.user_id:
-            curr_y += th + self.conf.getint("userid", "toppad")
-            if self.arg.no_auto_size:
-               size = self.conf.getint("userid", "size")
-            else:
-               size = self.base_text_size - 15
-            font = ImageFont.truetype(os.path.join(CUR_PATH, self.conf.get(
-                  "userid",
-                  "font")), size)
+            font_path, size, toppad, color = settings.text_styles["userid"]
+            curr_y += th + toppad
+            if not self.arg.no_auto_size:
+               size = settings.base_text_size - 15
+            font = _load_font(font_path, size)
             msg = "ID: " + self.user_id.strip()
-            tw, _ = draw.textsize(msg, font=font)
-            draw.text(((tpl_w - tw) / 2, curr_y), msg,
-                      self.conf.get("userid", "color"), font=font)
+            tw = _text_bbox(font_path, size, msg)[2]
+            draw.text(((tpl_w - tw) / 2, curr_y), msg, color, font=font)
 
          # Saved in the same relative location
-         self.bg_img.save(self.des_path + self.img_prefix + "-" +
-                          self.user_name.upper() + "_" +
-                          self.user_pos.upper() + "_" +
-                          self.user_id.upper() + "_" +
-                          str(self.img_num) + ".png", format="png")
+         out_file = os.path.join(self.des_path, "%s-%s_%s_%s_%s" % (
+               settings.img_prefix, self.user_name.upper(),
+               self.user_pos.upper(), self.user_id.upper(), self.img_num))
+         if self.arg.output_format == "webp":
+            self.bg_img.save(out_file + ".webp", "WEBP", quality=92,
+                             method=4)
+         else:
+            # zlib level 1 is several times faster than the default 6
+            self.bg_img.save(out_file + ".png", format="png",
+                             compress_level=1)
 
       except IOError as error:
          logger.error("Error: %s" % error)
 
 
+def positive_int(value):
+   """
+   argparse type for counts that must be at least 1
+   :param value: command line value
+   :return: int
+   """
+   try:
+      number = int(value)
+   except ValueError:
+      number = 0
+   if number < 1:
+      raise argparse.ArgumentTypeError("%r is not a positive integer" % value)
+   return number
+
+
 def add_args(parser, action='exec'):
    """
    :param parser:
@@ -499,6 +703,12 @@ def add_args(parser, action='exec'):
       parser.add_argument('-a', '--no-auto-size',
                           action='store_false', default=True,
                           help='Auto size for text')
+      parser.add_argument('-o', '--output-format',
+                          choices=['png', 'webp'], default='png',
+                          help='Output image format')
+      parser.add_argument('-w', '--workers',
+                          type=positive_int, default=os.cpu_count(),
+                          help='Number of badges generated in parallel')
       parser.add_argument('-l', '--loop',
                           type=bool, default=False,
                           help='Lopping the process')
@@ -541,46 +751,94 @@ def setup_logging(debug=False):
    logger = logging.getLogger('sLogger')
 
 
+def _init_worker(args, settings, parallel=True):
+   """
+   Prepare a worker process: logging, the face cascade and the shared
+   template are loaded once per process instead of once per badge
+   :param args: parsed CLI arguments
+   :param settings: Settings read from the config by the main process
+   :param parallel: False when badges are generated in the main process
+   """
+   setup_logging(args.debug)
+   if parallel:
+      # The pool already uses every core, OpenCV's own threads would only
+      # oversubscribe them
+      cv2.setNumThreads(1)
+      if hasattr(os, "nice"):
+         # Leave the GUI and the rest of the desktop responsive
+         os.nice(5)
+   if ImageMaker._get_face_model() is None:
+      ImageMaker._get_cascade()
+   _WORKER["args"] = args
+   _WORKER["settings"] = settings
+   _WORKER["parallel"] = parallel
+   # --test overlays a translucent template, prepare it once as well
+   _WORKER["template_img"] = Utility.load_template(
+         os.path.join(CUR_PATH, args.template), 125 if args.test else None)
+
+
+def _process_one(file_name):
+   """
+   Generate one badge in a worker process
+   :param file_name: source image file name
+   """
+   logger.info("Executing: %s" % file_name)
+   img_maker = ImageMaker(file_name, _WORKER["args"], _WORKER["settings"],
+                          _WORKER["template_img"])
+   img_maker.execute()
+
+
 def main(args, config):
    """
    Main processing
    :return:
    """
-   files = []
    src_path = os.path.join(CUR_PATH, args.src_path)
    des_path = os.path.join(CUR_PATH, args.des_path)
    tmp_path = os.path.join(CUR_PATH, config.get("general", "tmppath"))
    cv_path = os.path.join(CUR_PATH, config.get("general", "convertedpath"))
-   format_list = uT.get_dict_positions()
 
    if args.convert:
       ImageMaker.convert_images(src_path, cv_path)
       args.src_path = config.get("general", "convertedpath")
       src_path = cv_path
    if args.check_path:
-      Utility.check_folder([src_path, des_path, tmp_path])
+      os.makedirs(src_path, exist_ok=True)
+      Utility.check_folder([des_path, tmp_path])
 
-   for r, d, f in os.walk(src_path):
-      for file in f:
-         if any(s for s in format_list if s in file):
-            files.append(file)
+   # Badges are looked up by name in src_path, so only scan that folder
+   files = Utility.list_images(src_path)
    logger.debug("Exec file list: %s" % [item for item in files])
 
+   settings = Utility.get_settings(config)
    count = 0
-   while True:
-      start = time.time()
-      for file_name in files:
-         count += 1
-         logger.info("Executing: %s" % file_name)
-         img_maker = ImageMaker(file_name, args, config)
-         img_maker.execute()
-      end = time.time()
-      logger.info("Generated [" + str(count) + " items] in [" + str(end -
-                                                                    start) +
-                  "] seconds...")
-      if not args.loop:
-         return
-      Utility.countdown(int(args.interval))
+   executor = None
+   if args.debug and args.test and args.verbose:
+      # Face previews wait for a key press, keep them in this process
+      _init_worker(args, settings, parallel=False)
+   else:
+      # Badges are independent and CPU-bound, spread them over all cores
+      executor = ProcessPoolExecutor(max_workers=args.workers,
+                                     initializer=_init_worker,
+                                     initargs=(args, settings))
+   try:
+      while True:
+         start = time.perf_counter()
+         if executor:
+            # A few chunks per worker: less IPC, still balanced at the end
+            chunksize = max(1, len(files) // (args.workers * 4))
+            list(executor.map(_process_one, files, chunksize=chunksize))
+         else:
+            list(map(_process_one, files))
+         count += len(files)
+         logger.info("Generated [%d items] in [%.3f] seconds...", count,
+                     time.perf_counter() - start)
+         if not args.loop:
+            return
+         Utility.countdown(int(args.interval))
+   finally:
+      if executor:
+         executor.shutdown()
 
 
 if __name__ == "__main__":
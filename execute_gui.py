@@ -11,8 +11,11 @@ Copyright (C) 2021
    - python execute_gui.py <options>
 
 """
+import os
+import queue
 import re
 import subprocess
+import sys
 import tkinter as tk
 from threading import *
 from tkinter import colorchooser as tkcolor
@@ -25,6 +28,25 @@ CONF = './config/config.ini'
 SEED = 3
 HEIGHT = 500
 WIDTH = 800
+# Config value patterns deciding which widget edits a field
+RE_BOOL = re.compile(r'^(true|false)$', re.I)
+RE_COLOR = re.compile(r'^#(?:[0-9a-f]{6}|[0-9a-f]{3})$', re.I)
+RE_FOLDER = re.compile(r'^(.+)/([^/]+)/$')
+RE_FILE = re.compile(r'^(.+)/([^/]+)$')
+VENV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.venv')
+
+
+def get_python():
+   """
+   Interpreter for the generator: the project's .venv when there is one,
+   run.bat starts the GUI without activating it
+   :return: path to the python executable
+   """
+   for exe in (os.path.join(VENV, 'Scripts', 'python.exe'),
+               os.path.join(VENV, 'bin', 'python')):
+      if os.path.isfile(exe):
+         return exe
+   return sys.executable
 
 
 class MainWindow(tk.Frame):
@@ -50,6 +72,9 @@ class MainWindow(tk.Frame):
             length=280
             )
       self.processes = []
+      # Output of the worker thread, shown by the Tk thread in drain_queue()
+      self.queue = queue.Queue()
+      self.returncode = None
       self.init_window()
       self.create_widgets()
       self.stop_threads = False
@@ -100,45 +125,68 @@ class MainWindow(tk.Frame):
                    padx=5, pady=5, ipadx=5, ipady=5)
 
    def run(self):
-      t1 = Thread(target=self.pb.start)
-      t1.name = 'Progress Bar'
-      t1.start()
+      # Tk widgets may only be touched from this (main) thread
+      self.pb.start(50)
       t2 = Thread(target=self.execute)
       t2.name = "Image processing"
       t2.start()
-      self.processes.append(t1)
       self.processes.append(t2)
+      self.master.after(50, self.drain_queue, t2)
+
+   def drain_queue(self, worker):
+      """
+      Show the queued output, then poll again until the worker has finished
+      :param worker: image processing thread
+      """
+      done = not worker.is_alive()
+      chunks = []
+      while True:
+         try:
+            text, prefix = self.queue.get_nowait()
+         except queue.Empty:
+            break
+         chunks.append("%s%s" % (prefix, text))
+      if chunks:
+         # A single insert/scroll per poll, however many lines arrived
+         self.plogger.insert("".join(chunks), prefix="")
+      if not done:
+         self.master.after(50, self.drain_queue, worker)
+         return
+      self.kill_all()
+      if self.returncode:
+         messagebox.showerror(title="ERROR",
+                              message="Exited with code %d" % self.returncode,
+                              parent=self.master)
+      else:
+         messagebox.showinfo(title="Completed",
+                             message="Executed successfully!",
+                             parent=self.master)
+      self.plogger.insert("Stop ...")
 
    def kill_all(self):
       self.stop_threads = True
       self.pb.stop()
-      self.processes[0].join()
       return
 
    def execute(self):
       """
-      Execute
+      Execute, runs in a worker thread and reports through self.queue
       """
-      self.plogger.insert('\n'.join([f'{k}:{v[1]}' for k,
-                                                       v in
-                                     self.dict_val.items()]))
+      self.returncode = -1  # until the generator has exited
+      self.queue.put(('\n'.join([f'{k}:{v[1]}' for k,
+                                                  v in
+                                self.dict_val.items()]), " - "))
       self.save_config()
-      self.plogger.insert("Processing ...")
-      process = subprocess.Popen('runner.bat',
+      self.queue.put(("Processing ...", " - "))
+      # Run the generator directly, no cmd.exe/runner.bat hop
+      process = subprocess.Popen([get_python(), 'execute.py', 'exec', '-c'],
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.STDOUT,
-                                 shell=True)
-      output, error = process.communicate()
-      self.kill_all()
-      if error:
-         messagebox.showerror(title="ERROR", message=error, parent=self.master)
-      else:
-         self.plogger.insert(output)
-         messagebox.showinfo(title="Completed",
-                             message="Executed successfully!",
-                             parent=self.master)
-      self.plogger.insert("Stop ...")
-      self.kill_all()
+                                 bufsize=1, text=True)
+      # Show the generator's log as it comes instead of once it has exited
+      for line in process.stdout:
+         self.queue.put((line, ""))
+      self.returncode = process.wait()
 
    def select_text(self, event, key):
       """
@@ -210,24 +258,24 @@ class MainWindow(tk.Frame):
       :param col:
       """
       tb = None
-      if re.match(r'^([Tt][Rr][Uu][Ee]|[Ff][Aa][Ll][Ss][Ee])$', value):
+      if RE_BOOL.match(value):
          self.fit.set(bool(value))
          tb = tk.Checkbutton(master, text=key, height=2,
                              variable=self.fit,
                              command=lambda: self.select_bool('%s_%s' % (
                                 sec, key)))
          tb.grid(row=row, column=col, ipadx=5, sticky=tk.EW)
-      elif re.match(r'^#([a-fA-F0-9]{6}|[a-fA-F0-9]{3})$', value):
+      elif RE_COLOR.match(value):
          tb = tk.Button(master, text=value, width=20,
                         command=lambda: self.select_color(
                               '%s_%s' % (sec, key)))
          tb.grid(row=row, column=col, ipadx=5, sticky=tk.EW)
-      elif re.match(r'^(.+)\/([^\/]+)\/$', value):
+      elif RE_FOLDER.match(value):
          tb = tk.Button(master, text=value, width=20,
                         command=lambda: self.select_folder(
                               '%s_%s' % (sec, key)))
          tb.grid(row=row, column=col, ipadx=5, sticky=tk.EW)
-      elif re.match(r'^(.+)\/([^\/]+)$', value):
+      elif RE_FILE.match(value):
          tb = tk.Button(master, text=value, width=20,
                         command=lambda: self.select_file('%s_%s' % (sec, key)))
          tb.grid(row=row, column=col, ipadx=5, sticky=tk.EW)
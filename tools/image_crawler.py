@@ -12,18 +12,112 @@ Usage example:
 """
 
 import argparse
-import urllib.request
+import email.utils
 import logging
-import queue
+import os
+import random
+import shutil
 import sys
-import threading
 import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter, Retry
+
 from util import Utilities as ut
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
 CONF = '../config/'
 POS_MAP = {}
+POOL_SIZE = 30
+TIMEOUT = (3, 10)  # (connect, read) in seconds
+CHUNK_SIZE = 256 * 1024
+FILE_BUFFER = 1024 * 1024
+IMG_DIR = './img'
+BACKOFF_JITTER = 0.5
+BACKOFF_MAX = 30.0
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+
+class JitterRetry(Retry):
+    """
+    Retry with exponential backoff stretched by a random factor, so workers
+    failing together do not hit the server again in lock-step.
+    """
+
+    def get_backoff_time(self):
+        backoff = super(JitterRetry, self).get_backoff_time()
+        return min(BACKOFF_MAX, backoff * (1 + random.random() * BACKOFF_JITTER))
+
+
+class CircuitBreaker(object):
+    """
+    Stop hammering a host that keeps failing: after `threshold` consecutive
+    failures downloads are refused for `cooldown` seconds, then a single
+    probe is let through to decide whether to close again.
+
+    Refused downloads are not retried later in the same run, they are
+    dropped at once. Tasks are queued far faster than the cooldown, so in
+    practice the rest of the run is skipped; those IDs have no image yet
+    and are picked up by the next run.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return True when a download may be attempted.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half-open: this caller probes, the others are refused
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record(self, success):
+        """
+        Record the outcome of an attempted download.
+
+        Args:
+        - success (bool): Whether the host answered properly.
+        """
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+
+def make_session(pool_size=POOL_SIZE):
+    """
+    Create a session shared by every worker thread, so keep-alive connections
+    to the intranet host are reused instead of paying a handshake per image.
+
+    Args:
+    - pool_size (int): Connections kept per host, one per worker thread.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=JitterRetry(total=3, backoff_factor=0.2))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 class ImageCrawler(object):
@@ -32,11 +126,13 @@ class ImageCrawler(object):
 
     Methods:
     - __init__(*args, **kwargs): Initializes ImageCrawler.
-    - download_image(url, emp_id): Downloads an image from a given URL and employee ID.
-    - start_workers(thread_func, q, workers=None, **kwargs): Starts worker threads for image downloading tasks.
-    - start_tasks(q, tasks): Starts image downloading tasks using a queue.
-    - thread_func(q_item, thread_no): Function for worker threads to download images.
+    - download_image(emp_id): Downloads the image of a given employee ID.
+    - task_uid(emp_id): Returns the employee UID of a task.
+    - normalize_uid(uid): Returns the dedup key of a UID.
+    - downloaded_uids(): Returns the UIDs already present in the image folder.
     - run(): Runs the image crawler.
+    - check_results(done, pending): Logs the tasks that raised.
+    - close(): Releases the pooled connections.
     """
 
     def __init__(self, *args, **kwargs):
@@ -52,90 +148,179 @@ class ImageCrawler(object):
         super(ImageCrawler, self).__init__()
         self.arg = kwargs.get('arg', None)
         self.tasks = kwargs.get('tasks', None)
-        self.workers = range(int(kwargs.get('workers', 10)))
+        self.workers = int(kwargs.get('workers', 10))
         self.url = "https://intranet.t%sa.com.vn%s" % ('m', '/images/emp_images/big_new')
+        self.url_fmt = self.url + "/%d.jpg"
+        self.session = make_session(self.workers)
+        self.breaker = CircuitBreaker()
 
-    def download_image(self, url, emp_id):
+    def download_image(self, emp_id):
         """
-        Download an image from a given URL and employee ID.
+        Download the image of a given employee ID.
 
         Args:
-        - url (str): URL path for images.
-        - emp_id (str): Employee ID.
+        - emp_id (str|tuple): Employee ID, or (name, UID, position) for Excel
+          input.
         """
         prep = ''
+        uid = emp_id
         if self.arg.file_type == 0:
-            name, uid, pos = emp_id.split('_')
-            logger.info("emp_id :" + emp_id)
+            name, uid, pos = emp_id
+            logger.info("emp_id : %s_%s_%s", *emp_id)
         if uid.startswith(('T', 'B')):
             prep = uid[0]
             uid = uid[1:]
         # convert uid to int for remove heading zero, eg: 01234 -> 1234
-        url = "%s/%s.jpg" % (url, int(uid))
-        logger.debug('Downloading: %s' % url)
-        local_file = "./img/%s.jpg" % str(uid)
+        url = self.url_fmt % int(uid)
+        logger.debug('Downloading: %s', url)
+        local_file = "%s/%s.jpg" % (IMG_DIR, str(uid))
         if self.arg.file_type == 0:
-            local_file = "./img/%s_%s%s_%s_1.jpg" % (name, prep, str(uid), pos)
+            local_file = "%s/%s_%s%s_%s_1.jpg" % (IMG_DIR, name, prep, str(uid), pos)
+        if not self.breaker.allow():
+            logger.error("Skipped, host is failing, retry on the next run : "
+                         "%s - %s", local_file, url)
+            return
+        headers = {}
+        if self.arg.refresh and os.path.exists(local_file):
+            # Only send the body back if the photo changed since we saved it
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                os.path.getmtime(local_file), usegmt=True)
+        # A failed download must not leave a file that looks complete
+        part_file = local_file + '.part'
         try:
-            urllib.request.urlretrieve(url, local_file)
-            logger.info("Downloaded : %s" % local_file)
-        except Exception as err:
+            with self.session.get(url, headers=headers, stream=True,
+                                  timeout=TIMEOUT) as resp:
+                resp.raise_for_status()
+                if resp.status_code == 304:
+                    self.breaker.record(True)
+                    logger.info("Unchanged : %s", local_file)
+                    return
+                # undo any Content-Encoding while copying the raw stream
+                resp.raw.decode_content = True
+                with open(part_file, 'wb', buffering=FILE_BUFFER) as fp:
+                    shutil.copyfileobj(resp.raw, fp, length=CHUNK_SIZE)
+            os.replace(part_file, local_file)
+            self.breaker.record(True)
+            logger.info("Downloaded : %s", local_file)
+        except (requests.RequestException, urllib3.exceptions.HTTPError,
+                OSError) as err:
+            if isinstance(err, requests.HTTPError):
+                # 4xx means no photo for this ID, the host itself is fine
+                self.breaker.record(err.response.status_code < 500)
+            elif isinstance(err, (requests.RequestException,
+                                  urllib3.exceptions.HTTPError)):
+                self.breaker.record(False)
             logger.error("Failed to download : %s - %s" % (local_file, url))
+            try:
+                os.remove(part_file)
+            except OSError:
+                pass
             # raise err
 
-    def start_workers(self, thread_func, q, workers=None, **kwargs):
+    def task_uid(self, emp_id):
         """
-        Start worker threads for image downloading tasks.
+        Return the employee UID of a task, without its T/B prefix.
 
         Args:
-        - thread_func (function): Function for worker threads to download images.
-        - q (queue.Queue): Queue for tasks.
-        - workers (range): Range of worker threads (default: self.workers).
+        - emp_id (str|tuple): Employee ID, or (name, UID, position) for Excel
+          input.
         """
-        workers = workers if workers else self.workers
-        for worker in workers:
-            wk = threading.Thread(target=thread_func,
-                                  args=(q, worker,),
-                                  daemon=True)
-            wk.start()
+        uid = emp_id[1] if self.arg.file_type == 0 else emp_id
+        return self.normalize_uid(uid)
 
-    def start_tasks(self, q, tasks):
+    @staticmethod
+    def normalize_uid(uid):
         """
-        Start image downloading tasks using a queue.
+        Return the dedup key of a UID: without its T/B prefix and, like the
+        download URL, without leading zeros (T0123, 0123 and 123 are one
+        employee).
 
         Args:
-        - q (queue.Queue): Queue for tasks.
-        - tasks (list): List of tasks to download images.
+        - uid (str): Employee UID, possibly prefixed.
         """
-        for i in tasks:
-            i = i.strip()
-            q.put(i)
-        q.join()
+        uid = uid[1:] if uid.startswith(('T', 'B')) else uid
+        try:
+            return str(int(uid))
+        except ValueError:
+            return uid
 
-    def thread_func(self, q_item, thread_no):
+    @staticmethod
+    def downloaded_uids():
         """
-        Function for worker threads to download images.
-
-        Args:
-        - q_item (queue.Queue): Queue item for tasks.
-        - thread_no (int): Thread number.
+        Return the set of UIDs that already have an image, from a single scan
+        of the image folder.
         """
-        while True:
-            task_item = q_item.get()
-            ImageCrawler.download_image(self, self.url, task_item)
-            q_item.task_done()
-            logger.debug('Thread [%s] is doing [%s]...' %
-                         (str(thread_no), str(task_item)))
+        uids = set()
+        with os.scandir(IMG_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.jpg'):
+                    # UID.jpg or Name_UID_Position_N.jpg
+                    parts = os.path.splitext(entry.name)[0].split('_')
+                    uid = parts[1] if len(parts) > 1 else parts[0]
+                    uids.add(ImageCrawler.normalize_uid(uid))
+        return uids
 
     def run(self):
         """
         Run the image crawler.
+
+        Tasks are handed to a thread pool with at most two pending downloads
+        per worker, so a long (or lazily read) task list is never queued up
+        front. Employees whose image is already in the image folder, or who
+        were already queued earlier in the list, are skipped. With --refresh
+        existing images are re-checked instead and only fetched if changed.
         """
-        q = queue.Queue()
-        self.start_workers(self.thread_func, q)
-        self.start_tasks(q, self.tasks)
+        max_pending = self.workers * 2
+        # Every download lands in the same folder, create it once up front
+        os.makedirs(IMG_DIR, exist_ok=True)
+        # UIDs on disk (unless they are re-checked), plus every UID queued
+        present = set() if self.arg.refresh else self.downloaded_uids()
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='crawler') as executor:
+            # future -> task, to tell which task an unexpected error belongs to
+            pending = {}
+            try:
+                for task in self.tasks:
+                    uid = self.task_uid(task)
+                    if uid in present:
+                        logger.debug("Already downloaded : %s", task)
+                        continue
+                    present.add(uid)
+                    if len(pending) >= max_pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        self.check_results(done, pending)
+                    pending[executor.submit(self.download_image, task)] = task
+                done, _ = wait(pending)
+                self.check_results(done, pending)
+            except KeyboardInterrupt:
+                for future in pending:
+                    future.cancel()
+                raise
         return
 
+    @staticmethod
+    def check_results(done, pending):
+        """
+        Log the errors download_image() did not handle itself, e.g. an ID
+        that is not a number, and forget the finished futures.
+
+        Args:
+        - done (set): Finished futures.
+        - pending (dict): Futures still tracked, mapped to their task.
+        """
+        for future in done:
+            task = pending.pop(future)
+            err = future.exception()
+            if err is not None:
+                logger.error("Task failed : %s", task,
+                             exc_info=(type(err), err, err.__traceback__))
+
+    def close(self):
+        """
+        Close the session and its pooled keep-alive connections.
+        """
+        self.session.close()
+
 
 def setup_logging(debug=False):
     """
@@ -162,7 +347,11 @@ def parse_arguments():
     """
     Parse command-line arguments.
     """
-    parser = argparse.ArgumentParser(description='Image Crawler')
+    parser = argparse.ArgumentParser(
+        description='Image Crawler',
+        epilog='After %d consecutive server errors or timeouts the remaining '
+               'downloads are skipped for %d seconds; run again to fetch the '
+               'skipped IDs.' % (BREAKER_THRESHOLD, BREAKER_COOLDOWN))
     parser.add_argument('-w', '--workers', type=int, default=30,
                         help='Number of workers')
     parser.add_argument('-f', '--file-path', type=str, default="./data.xlsx", nargs='?',
@@ -170,6 +359,8 @@ def parse_arguments():
     parser.add_argument('-l', '--link', type=str, 
                         default="https://intranet.t%sa.com.vn" % 'm', nargs='?',
                         help='Path to the folder to create mock data')
+    parser.add_argument('-r', '--refresh', action='store_true',
+                        help='Re-check downloaded images, fetch only changed ones')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Enable debug mode')
     return parser.parse_args()
@@ -184,25 +375,38 @@ def get_data(file):
 
     Returns:
     - int: File type (0: excel, 1: other formats).
-    - list: List of tasks/data.
+    - iterable: Tasks/data, (name, UID, position) tuples for Excel, IDs read
+      lazily for plain ID lists.
     """
     if ut.check_file_type(file) == 'excel':
-        data = []
+        # Keyed by UID, a repeated row is only downloaded once
+        data = {}
         from openpyxl import load_workbook
-        workbook = load_workbook(filename=file)
+        # Stream the rows instead of building the whole cell model
+        workbook = load_workbook(filename=file, read_only=True, data_only=True)
         sheet = workbook.active
-        skip_first_row = True
-        for row in sheet.iter_rows(values_only=True):
-            if skip_first_row:
-                skip_first_row = False
-                continue
+        # Skip the header row and only read the No/UID/Name/Position columns
+        for row in sheet.iter_rows(min_row=2, max_col=4, values_only=True):
             uid, name, pos = row[1:4]
-            data.append('_'.join([name, str(uid), pos]))
+            data[str(uid)] = (name, str(uid), pos)
         workbook.close()
-        return 0, data
+        return 0, data.values()
     else:
-        with open(file, 'r') as id_list:
-            return 1, id_list.readlines()
+        return 1, read_ids(file)
+
+
+def read_ids(file):
+    """
+    Yield the stripped, non-empty lines of an ID list file.
+
+    Args:
+    - file (str): File path.
+    """
+    with open(file, 'r') as id_list:
+        for line in id_list:
+            line = line.strip()
+            if line:
+                yield line
 
 
 def main(args):
@@ -217,7 +421,10 @@ def main(args):
     f_type, tasks = get_data(args.file_path)
     args.file_type = f_type
     imgc = ImageCrawler(arg=args, tasks=tasks, workers=args.workers)
-    imgc.run()
+    try:
+        imgc.run()
+    finally:
+        imgc.close()
     return
 
 
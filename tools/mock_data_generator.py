@@ -68,10 +68,11 @@ class ImageNameVerifier:
         mock_folder = os.path.join(self.folder_path, 'mock_images')
         self.logger.info(f"Mock folder: {mock_folder}")
         if os.path.exists(mock_folder):
-            for filename in os.listdir(mock_folder):
-                file_path = os.path.join(mock_folder, filename)
-                self.logger.info(f"Removed file: {filename}")
-                os.remove(file_path)
+            with os.scandir(mock_folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        os.remove(entry.path)
+                        self.logger.info(f"Removed file: {entry.name}")
 
     def get_fullname(self, gender=True):
         if gender: